@@ -3,14 +3,18 @@
 # Streamlit App — NOAA NWPS Gauge Network Map (Google Satellite base)
 
 import streamlit as st
-import requests
+import httpx
 import folium
-from streamlit_folium import st_folium
+from folium.plugins import FastMarkerCluster
 import pandas as pd
 import time
-import io
-import re
-import concurrent.futures
+import asyncio
+import html
+import json
+import orjson
+import sqlite3
+import threading
+from pathlib import Path
 import plotly.express as px
 
 # ---------------- Streamlit Setup ----------------
@@ -231,115 +235,414 @@ station_data_string = station_data_string = """site_no station_nm      lat     l
 """
 
 # ---------------- Parse the Station Data ----------------
-# Replace 2+ spaces with a single tab to make columns uniform
-cleaned = re.sub(r'\s{2,}', '\t', station_data_string.strip())
-
-# Parse the text as a tab-separated file
-stations_df = pd.read_csv(
-    io.StringIO(cleaned),
-    sep='\t',
-    names=["site_no", "station_nm", "lat", "lon"],
-    engine="python"
-)
+# The table is constant, so parse it once per process rather than on every rerun.
+# The returned frame is shared between sessions and must not be mutated.
+@st.cache_resource
+def _load_stations():
+    # Columns are space-aligned but names contain spaces (and are not always padded),
+    # so split lat/lon off the right of each line and site_no off the left.
+    lines = pd.Series(station_data_string.strip().splitlines()[1:])
+    coords = lines.str.rsplit(n=2, expand=True)
+    ids = coords[0].str.split(n=1, expand=True)
+
+    # Convert lat/lon to numeric and drop any invalid rows
+    df = pd.DataFrame({
+        "site_no": ids[0],
+        "station_nm": ids[1],
+        "lat": pd.to_numeric(coords[1], errors="coerce"),
+        "lon": pd.to_numeric(coords[2], errors="coerce"),
+    })
+    df = df.dropna(subset=["lat", "lon"]).reset_index(drop=True)
+
+    # Map center and the station id list are just as constant as the table
+    avg_lat = float(df["lat"].to_numpy().mean())
+    avg_lon = float(df["lon"].to_numpy().mean())
+    site_ids = df["site_no"].tolist()
+
+    # float32 keeps well under a metre of precision; Arrow strings avoid a
+    # Python object per cell
+    df = df.astype({
+        "site_no": "string[pyarrow]",
+        "station_nm": "string[pyarrow]",
+        "lat": "float32",
+        "lon": "float32",
+    })
+    return df, avg_lat, avg_lon, site_ids
+
+stations_df, avg_lat, avg_lon, site_ids = _load_stations()
+
+# ---------------- Persistent Response Cache ----------------
+# NOAA refreshes stageflow roughly every 15 minutes
+NOAA_TTL = 900
+
+
+class ResponseCache:
+    """SQLite cache of gauge responses shared by every session and container restart."""
+
+    def __init__(self, path):
+        self._lock = threading.Lock()
+        self._conn = sqlite3.connect(path, check_same_thread=False)
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.execute(
+            "CREATE TABLE IF NOT EXISTS responses "
+            "(site_id TEXT PRIMARY KEY, ts REAL, ttl REAL, data BLOB)"
+        )
+
+    def get(self, site_id, stale_ok=False):
+        """Return ``(data, fetched_ts)`` for a site, or None if missing (or expired, unless stale_ok)."""
+        with self._lock:
+            row = self._conn.execute(
+                "SELECT ts, ttl, data FROM responses WHERE site_id = ?", (site_id,)
+            ).fetchone()
+        if row is None:
+            return None
+        ts, ttl, data = row
+        if not stale_ok and time.time() - ts > ttl:
+            return None
+        return orjson.loads(data), ts
+
+    def set(self, site_id, data, ts, ttl=NOAA_TTL):
+        with self._lock, self._conn:
+            self._conn.execute(
+                "INSERT OR REPLACE INTO responses VALUES (?, ?, ?, ?)",
+                (site_id, ts, ttl, orjson.dumps(data)),
+            )
+
+
+@st.cache_resource
+def _response_cache():
+    return ResponseCache(Path(__file__).parent / ".noaa_cache.sqlite")
 
-# Convert lat/lon to numeric and drop any invalid rows
-stations_df["lat"] = pd.to_numeric(stations_df["lat"], errors="coerce")
-stations_df["lon"] = pd.to_numeric(stations_df["lon"], errors="coerce")
-stations_df = stations_df.dropna(subset=["lat", "lon"]).reset_index(drop=True)
+
+cache = _response_cache()
 
 # ---------------- Fetch NOAA NWPS Data ----------------
+NOAA_URL = "https://api.water.noaa.gov/nwps/v1/gauges/{id}/stageflow"
+
+# Connection pool and retry policy shared by every gauge request
+HTTP_LIMITS = httpx.Limits(max_connections=20, max_keepalive_connections=20)
+HTTP_TIMEOUT = httpx.Timeout(10, connect=3)
+HTTP_RETRIES = 2
+HTTP_BACKOFF = 0.2
+RETRY_STATUSES = {502, 503, 504}
+
+async def _get_with_retry(client, url):
+    for attempt in range(HTTP_RETRIES + 1):
+        r = await client.get(url)
+        if r.status_code not in RETRY_STATUSES or attempt == HTTP_RETRIES:
+            return r
+        await asyncio.sleep(HTTP_BACKOFF * 2 ** attempt)
+
+async def _get_data(client, site_id, force=False):
+    """Return ``(site_id, data, fetched_ts)``; ``force`` skips fresh cache entries."""
+    cached = None if force else cache.get(site_id)
+    if cached is not None:
+        return site_id, *cached
+
+    try:
+        r = await _get_with_retry(client, NOAA_URL.format(id=site_id))
+        r.raise_for_status()
+        data = orjson.loads(r.content)
+    except Exception as e:
+        # Stale if error: an expired reading beats an empty marker during an outage
+        stale = cache.get(site_id, stale_ok=True)
+        if stale is not None:
+            return site_id, *stale
+        return site_id, {"error": str(e)}, None
+
+    fetched_ts = time.time()
+    cache.set(site_id, data, fetched_ts, ttl=NOAA_TTL)
+    return site_id, data, fetched_ts
+
+async def _fetch_all(stations, force=False):
+    # One pooled HTTP/2 client for every gauge instead of a thread per request.
+    # The transport retries failed connects; _get_with_retry handles 5xx.
+    transport = httpx.AsyncHTTPTransport(
+        http2=True, limits=HTTP_LIMITS, retries=HTTP_RETRIES
+    )
+    async with httpx.AsyncClient(transport=transport, timeout=HTTP_TIMEOUT) as client:
+        return await asyncio.gather(*(_get_data(client, s, force) for s in stations))
+
+def fetch_gauges(stations, force=False):
+    """Return ``(responses, fetched_at)``, both keyed by site id.
+
+    ``fetched_at`` holds when each response actually came from NOAA (None on error).
+    """
+    results = asyncio.run(_fetch_all(stations, force))
+    responses = {site_id: data for site_id, data, _ in results}
+    fetched_at = {site_id: ts for site_id, _, ts in results}
+    return responses, fetched_at
+
+# st.cache_data is the in-memory layer; ResponseCache backs it across sessions and restarts
 @st.cache_data(ttl=600)
 def fetch_noaa_data(stations):
-    base_url = "https://api.water.noaa.gov/nwps/v1/gauges/{id}/stageflow"
-    responses = {}
+    return fetch_gauges(stations)
 
-    def get_data(site_id):
-        url = base_url.format(id=site_id)
-        try:
-            r = requests.get(url, timeout=10)
-            r.raise_for_status()
-            return site_id, r.json()
-        except Exception as e:
-            return site_id, {"error": str(e)}
+# ---------------- Stale-While-Revalidate ----------------
+def _refresh(stations, pending, force):
+    """Fetch fresh gauge data off the script thread; swapped in on a later rerun."""
+    try:
+        pending["data"] = fetch_gauges(stations, force=force)
+    finally:
+        pending["done"] = True
 
-    with concurrent.futures.ThreadPoolExecutor(max_workers=10) as executor:
-        for site_id, data in executor.map(get_data, stations):
-            responses[site_id] = data
+@st.fragment(run_every=2)
+def _await_refresh():
+    pending = st.session_state["noaa_data_next"]
+    if pending.get("done"):
+        st.rerun()
+    if pending.get("force_queued"):
+        st.caption("🔄 Finishing a scheduled update; your refresh runs right after...")
+    else:
+        st.caption("🔄 Refreshing gauge data in the background...")
 
-    return responses
+# Minimum gap between scheduled refreshes, so gauges that keep erroring (and so
+# never look fresh) don't start a new thread on every rerun
+REFRESH_THROTTLE = 120
 
-if refresh or "noaa_data" not in st.session_state:
+# Only the very first load blocks; afterwards the previous data is served while
+# a background thread refreshes it.
+if "noaa_data" not in st.session_state:
     with st.spinner("Fetching latest gauge data from NOAA..."):
-        st.session_state["noaa_data"] = fetch_noaa_data(stations_df["site_no"].tolist())
+        st.session_state["noaa_data"], st.session_state["noaa_fetched_at"] = (
+            fetch_noaa_data(site_ids)
+        )
 
-responses = st.session_state["noaa_data"]
+pending = st.session_state.get("noaa_data_next")
+force_queued = False
+if pending is not None and pending.get("done"):
+    if "data" in pending:
+        st.session_state["noaa_data"], st.session_state["noaa_fetched_at"] = pending["data"]
+        st.session_state.pop("map_html", None)
+    force_queued = pending.get("force_queued", False)
+    del st.session_state["noaa_data_next"]
+    pending = None
 
-# ---------------- Map Setup (Google Satellite) ----------------
-avg_lat = stations_df["lat"].mean()
-avg_lon = stations_df["lon"].mean()
+# Refresh during a scheduled (cache-honouring) update: queue the forced fetch
+# for when it lands instead of dropping the click
+if refresh and pending is not None and not pending["force"]:
+    pending["force_queued"] = True
 
-m = folium.Map(
-    location=[avg_lat, avg_lon],
-    zoom_start=7,
-    control_scale=True,
-    tiles=None
-)
+# Staleness follows the age of the data itself (it may come from the cache layers),
+# not when this session received it. Gauges with no successful fetch count as stale.
+fetched_at = st.session_state["noaa_fetched_at"].values()
+stale = not fetched_at or None in fetched_at or time.time() - min(fetched_at) > NOAA_TTL
+throttled = time.time() - st.session_state.get("last_refresh_ts", 0) < REFRESH_THROTTLE
+if (refresh or force_queued or (stale and not throttled)) and pending is None:
+    # The Refresh button bypasses fresh cache entries; a scheduled refresh honours them
+    force = refresh or force_queued
+    pending = st.session_state["noaa_data_next"] = {"force": force}
+    st.session_state["last_refresh_ts"] = time.time()
+    threading.Thread(
+        target=_refresh, args=(site_ids, pending, force), daemon=True
+    ).start()
+
+if pending is not None:
+    _await_refresh()
 
-folium.TileLayer(
-    tiles="https://mt1.google.com/vt/lyrs=s,h&x={x}&y={y}&z={z}",
-    attr="Map data ©2025 Google",
-    name="Google Satellite",
-    overlay=False,
-    control=True,
-).add_to(m)
+responses = st.session_state["noaa_data"]
 
 # ---------------- Add Station Markers ----------------
-valid_count = 0
-
-for _, row in stations_df.iterrows():
-    site = str(row["site_no"])
-    lat, lon = row["lat"], row["lon"]
-    data = responses.get(site, {})
-    color = "red"
-    popup_html = f"<b>Station:</b> {site}<br><b>Name:</b> {row['station_nm']}<br>"
-
-    if data and "error" not in data:
-        valid_count += 1
-        color = "blue"
-        popup_html += f"<b>Valid Time:</b> {data.get('validTime','N/A')}<br>"
-        popup_html += f"<b>Generated Time:</b> {data.get('generatedTime','N/A')}<br>"
-        popup_html += f"<b>Primary:</b> {data.get('primary','N/A')}<br>"
-        popup_html += f"<b>Secondary:</b> {data.get('secondary','N/A')}<br>"
-
-        obs_data = data.get("observed", {}).get("data", [])
-        if obs_data:
-            obs = obs_data[-1]
-            popup_html += f"<b>Most Recent Observation:</b> {obs}"
-    else:
-        popup_html += f"⚠️ No API data<br>{data.get('error','')}"
-
-    folium.CircleMarker(
-        location=[lat, lon],
-        radius=6,
-        color=color,
-        fill=True,
-        fill_opacity=0.9,
-        popup=folium.Popup(popup_html, max_width=300),
-        tooltip=f"{row['station_nm']} ({site})"
+POPUP_FIELDS = ["validTime", "generatedTime", "primary", "secondary", "error"]
+
+def _escape(value):
+    return html.escape(str(value), quote=False)
+
+def _flatten(data):
+    """Flatten one level of nesting into dotted keys, like json_normalize(max_level=1)."""
+    flat = {}
+    for key, value in data.items():
+        if isinstance(value, dict):
+            flat.update({f"{key}.{sub}": v for sub, v in value.items()})
+        else:
+            flat[key] = value
+    return flat
+
+def _popup_cell(value):
+    # Absent keys come back as the NaN pandas fills in; JSON itself has no NaN
+    if isinstance(value, float) and value != value:
+        return "N/A"
+    return _escape(value)
+
+def build_popups(stations, responses):
+    """Return the popup HTML for every station, built column-wise.
+
+    ``stations`` must carry the boolean ``has_data`` column.
+    """
+    # Flatten every response once and join it onto the stations by site_no.
+    # Object dtype keeps readings exactly as NOAA sent them (no int -> float upcast).
+    resp_df = pd.DataFrame(
+        [{**_flatten(responses.get(s) or {}), "site_no": s} for s in stations["site_no"]],
+        dtype=object,
+    ).reindex(columns=["site_no", "observed.data", *POPUP_FIELDS])
+    merged = stations[["site_no"]].merge(
+        resp_df.astype({"site_no": stations["site_no"].dtype}), on="site_no", how="left"
+    ).set_axis(stations.index)
+
+    # Escape everything interpolated into the popup once, here; Leaflet's
+    # bindPopup inserts the finished string as HTML without further processing
+    meta = merged[POPUP_FIELDS].astype(object).map(_popup_cell)
+    last_obs = merged["observed.data"].map(
+        lambda obs: obs[-1] if isinstance(obs, list) and obs else None
+    )
+
+    base = (
+        "<b>Station:</b> " + stations["site_no"]
+        + "<br><b>Name:</b> " + stations["station_nm"].map(_escape) + "<br>"
+    )
+    ok = (
+        base
+        + "<b>Valid Time:</b> " + meta["validTime"] + "<br>"
+        + "<b>Generated Time:</b> " + meta["generatedTime"] + "<br>"
+        + "<b>Primary:</b> " + meta["primary"] + "<br>"
+        + "<b>Secondary:</b> " + meta["secondary"] + "<br>"
+        + ("<b>Most Recent Observation:</b> " + last_obs.map(_escape)).where(
+            last_obs.notna(), ""
+        )
+    )
+    failed = base + "⚠️ No API data<br>" + meta["error"].replace("N/A", "")
+    return ok.where(stations["has_data"], failed)
+
+# ---------------- Map Setup ----------------
+MAP_ZOOM = 7
+
+MARKER_CALLBACK = """
+function (row) {
+    return L.circleMarker(new L.LatLng(row[0], row[1]), {
+        radius: 6, color: "%(color)s", fillColor: "%(color)s", fill: true, fillOpacity: 0.9
+    }).bindPopup(row[2], {maxWidth: 300}).bindTooltip(row[3]);
+}
+"""
+
+# Clusters take their layer's color, so a bubble of failed stations is never
+# mistaken for one of working stations when zoomed out
+CLUSTER_ICON = """
+function (cluster) {
+    return L.divIcon({
+        html: '<div style="background: %(color)s; color: white; border-radius: 50%%; '
+            + 'width: 30px; height: 30px; line-height: 30px; text-align: center; '
+            + 'font-weight: bold; opacity: 0.85;">' + cluster.getChildCount() + '</div>',
+        className: "",
+        iconSize: L.point(30, 30)
+    });
+}
+"""
+
+def marker_rows(stations):
+    """Return [lat, lon, popup, tooltip] rows for FastMarkerCluster."""
+    tooltips = (stations["station_nm"] + " (" + stations["site_no"] + ")").map(_escape)
+    return [
+        # itertuples yields Python floats; 6 decimals is all float32 resolves
+        [round(lat, 6), round(lon, 6), popup, tooltip]
+        for lat, lon, popup, tooltip in stations[["lat", "lon", "popup"]]
+        .assign(tooltip=tooltips)
+        .itertuples(index=False, name=None)
+    ]
+
+# Rendering the map is the most expensive part of a rerun; cache the HTML on the
+# response snapshot so benign reruns reuse it.
+@st.cache_data(ttl=600)
+def render_map(responses_key, _responses, stations, center):
+    """Render the gauge map to standalone HTML and count stations with data.
+
+    ``responses_key`` (the serialized responses) only keys the cache; the map is
+    built from the unhashed ``_responses`` so NOAA's field order is preserved.
+    """
+    # Google Satellite base
+    m = folium.Map(
+        location=list(center),
+        zoom_start=MAP_ZOOM,
+        control_scale=True,
+        tiles=None
+    )
+
+    folium.TileLayer(
+        tiles="https://mt1.google.com/vt/lyrs=s,h&x={x}&y={y}&z={z}",
+        attr="Map data ©2025 Google",
+        name="Google Satellite",
+        overlay=False,
+        control=True,
     ).add_to(m)
 
-folium.LayerControl().add_to(m)
+    # Flag stations with usable data once, then give each group its own cluster
+    # layer with a fixed marker style instead of branching per marker
+    markers = stations.assign(
+        has_data=stations["site_no"].map(
+            lambda s: bool(_responses.get(s)) and "error" not in _responses[s]
+        ).astype(bool)
+    )
+    markers["popup"] = build_popups(markers, _responses)
+    good = markers[markers["has_data"]]
+    bad = markers[~markers["has_data"]]
+
+    # Markers are built client-side by FastMarkerCluster from plain row arrays
+    # instead of one Python object per station. Clustering is off from the
+    # starting zoom up, so the opening view shows every station's own color.
+    for group, color, name in ((good, "blue", "Gauges"), (bad, "red", "Gauges without data")):
+        FastMarkerCluster(
+            marker_rows(group),
+            callback=MARKER_CALLBACK % {"color": color},
+            icon_create_function=CLUSTER_ICON % {"color": color},
+            name=name,
+            options={"disableClusteringAtZoom": MAP_ZOOM},
+        ).add_to(m)
+
+    folium.LayerControl().add_to(m)
+
+    return m.get_root().render(), len(good)
+
+# The map only changes with the gauge data, so sidebar reruns reuse the stored HTML
+# without even hashing the responses. Swapping in refreshed data clears it.
+if "map_html" not in st.session_state:
+    st.session_state["map_html"], st.session_state["valid_count"] = render_map(
+        json.dumps(responses, sort_keys=True), responses, stations_df, (avg_lat, avg_lon)
+    )
+valid_count = st.session_state["valid_count"]
 
 # ---------------- Map Display ----------------
 st.markdown(
     f"**Total Stations:** {len(stations_df)} | ✅ Successful: {valid_count} | ⚠️ Failed: {len(stations_df) - valid_count}"
 )
-st.caption(f"Last updated: {time.strftime('%Y-%m-%d %H:%M:%S UTC')}")
-st_folium(m, width=1000, height=650)
+# Report when the data actually came from NOAA, not when this session got it
+fetched = [ts for ts in st.session_state["noaa_fetched_at"].values() if ts is not None]
+if fetched:
+    caption = f"Last updated: {time.strftime('%Y-%m-%d %H:%M:%S UTC', time.gmtime(max(fetched)))}"
+    if max(fetched) - min(fetched) > 60:
+        caption += f" (oldest gauge data from {time.strftime('%Y-%m-%d %H:%M:%S UTC', time.gmtime(min(fetched)))})"
+    st.caption(caption)
+else:
+    st.caption("Last updated: no gauge data received yet")
+st.iframe(st.session_state["map_html"], height=650)
 
 # ---------------- Sidebar: Station Data Viewer ----------------
+# Memoized so flipping back to a station that was already viewed skips both the
+# frame build and the Plotly figure generation
+@st.cache_data(ttl=600)
+def observed_frame(obs_list):
+    # Build the frame column by column instead of through the generic
+    # records constructor, which infers every column per dict
+    obs_df = pd.DataFrame({
+        "validTime": [d.get("validTime") for d in obs_list],
+        "primary": pd.to_numeric([d.get("primary") for d in obs_list], errors="coerce"),
+        "secondary": pd.to_numeric([d.get("secondary") for d in obs_list], errors="coerce"),
+    })
+    obs_df["time"] = pd.to_datetime(
+        obs_df["validTime"], format="ISO8601", errors="coerce", utc=True
+    )
+    return obs_df.dropna(subset=["time"])
+
+@st.cache_data(ttl=600)
+def observed_figure(site_id, obs_df, y_col):
+    return px.line(
+        obs_df,
+        x="time",
+        y=y_col,
+        title=f"Observed {y_col} — Station {site_id}",
+        labels={y_col: y_col.capitalize(), "time": "Time (UTC)"},
+    )
+
 st.sidebar.header("📊 Station Data Viewer")
-selected_station = st.sidebar.selectbox("Select a Station", stations_df["site_no"].tolist())
+selected_station = st.sidebar.selectbox("Select a Station", site_ids)
 
 if selected_station:
     data = responses.get(str(selected_station))
@@ -350,19 +653,21 @@ if selected_station:
         and "observed" in data
         and "data" in data["observed"]
     ):
-        obs_df = pd.DataFrame(data["observed"]["data"])
-        if not obs_df.empty:
-            obs_df["time"] = pd.to_datetime(obs_df.get("validTime"), errors="coerce")
-            obs_df = obs_df.dropna(subset=["time"])
-            y_col = "primary" if "primary" in obs_df.columns else obs_df.columns[1]
-            fig = px.line(
-                obs_df,
-                x="time",
-                y=y_col,
-                title=f"Observed {y_col} — Station {selected_station}",
-                labels={y_col: y_col.capitalize(), "time": "Time (UTC)"},
+        obs_list = data["observed"]["data"]
+        if obs_list:
+            obs_df = observed_frame(obs_list)
+            y_col = "primary"
+            st.sidebar.caption(f"Observed {y_col} — Station {selected_station}")
+            st.sidebar.line_chart(
+                obs_df.set_index("time")[[y_col]],
+                x_label="Time (UTC)",
+                y_label=y_col.capitalize(),
             )
-            st.sidebar.plotly_chart(fig, use_container_width=True)
+            # A toggle rather than an expander: expander contents still run and
+            # would ship the Plotly payload on every rerun
+            if st.sidebar.toggle("Advanced plot"):
+                fig = observed_figure(selected_station, obs_df, y_col)
+                st.sidebar.plotly_chart(fig, width="stretch")
         else:
             st.sidebar.warning("No observation data available for this station.")
     else: